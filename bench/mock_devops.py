@@ -0,0 +1,394 @@
+"""
+Local mock of the Azure DevOps Work Item Tracking REST API, for benchmarking the extractor.
+
+Serves the WIQL, workitems, workitemsbatch (with asOf), revisions and reporting revisions endpoints
+from a generated portfolio of Program Deliverable Work Items, with configurable latency, jitter and
+injected 429 throttling.
+
+Usage:
+    $ python bench/mock_devops.py --port 8080 --items 1000 --weeks 52
+    then point the "url" of a config file at http://127.0.0.1:8080
+"""
+import bisect
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+logger = logging.getLogger(__name__)
+
+# Resource locations returned by OPTIONS /_apis, the client builds its request URLs from these
+RESOURCE_LOCATIONS = [
+    {'id': 'e81700f7-3be2-46de-8624-2eb35882fcaa', 'area': 'Location', 'resourceName': 'ResourceAreas',
+     'routeTemplate': '_apis/{resource}/{areaId}'},
+    {'id': '603fe2ac-9723-48b9-88ad-09305aa6c6e1', 'area': 'core', 'resourceName': 'projects',
+     'routeTemplate': '_apis/{resource}/{*projectId}'},
+    {'id': '1a9c53f7-f243-4447-b110-35ef023636e4', 'area': 'wit', 'resourceName': 'wiql',
+     'routeTemplate': '{project}/{team}/_apis/{area}/{resource}/{id}'},
+    {'id': '72c7ddf8-2cdc-4f60-90cd-ab71c14a399b', 'area': 'wit', 'resourceName': 'workItems',
+     'routeTemplate': '{project}/_apis/{area}/{resource}/{id}'},
+    {'id': '908509b6-4248-4475-a1cd-829139ba419f', 'area': 'wit', 'resourceName': 'workItemsBatch',
+     'routeTemplate': '{project}/_apis/{area}/{resource}'},
+    {'id': 'a00c85a5-80fa-4565-99c3-bcd2181434bb', 'area': 'wit', 'resourceName': 'revisions',
+     'routeTemplate': '{project}/_apis/{area}/workItems/{id}/{resource}/{revisionNumber}'},
+    {'id': 'f828fe59-dd87-495d-a17c-7a8d6211ca6c', 'area': 'wit', 'resourceName': 'workItemRevisions',
+     'routeTemplate': '{project}/_apis/{area}/reporting/{resource}'},
+]
+for _location in RESOURCE_LOCATIONS:
+    _location.update({'resourceVersion': 3, 'minVersion': 1.0, 'maxVersion': 6.0, 'releasedVersion': '6.0'})
+
+MAX_BATCH_SIZE = 200
+REPORTING_PAGE_SIZE = 200
+
+
+def format_date(value):
+    """Dates as sent by Azure DevOps, with milliseconds"""
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(value.microsecond // 1000)
+
+
+def parse_date(value):
+    """asOf dates as sent by the client, to a naive UTC datetime"""
+    value = unquote(value).strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    value = value.split('+')[0]
+    if '.' in value:
+        value, fraction = value.split('.')
+        value += '.' + fraction[:6].ljust(6, '0')
+    return datetime.datetime.fromisoformat(value)
+
+
+class Portfolio:
+    """Generated Work Items, each with its revisions sorted by changed date.
+    The Actual percentage of an item increases over its revisions, from its creation to today.
+    """
+
+    def __init__(self, items=1000, start_date=None, weeks=52, seed=1, project_name="Bench"):
+        rnd = random.Random(seed)
+        today = datetime.datetime.utcnow().replace(microsecond=0)
+        if start_date is None:
+            start_date = today - datetime.timedelta(weeks=weeks)
+        project_days = max(1, (today - start_date).days)
+
+        self.project_name = project_name
+        self.ids = []
+        self._revisions = {}
+        self._changed_dates = {}
+        for index in range(items):
+            id_ = 1000 + index
+            created = start_date + datetime.timedelta(seconds=rnd.randint(0, project_days * 86400 // 2))
+            green_start = start_date + datetime.timedelta(days=rnd.randint(0, project_days))
+            red_start = green_start + datetime.timedelta(days=rnd.randint(0, 14))
+            fields = {
+                'System.Id': id_,
+                'System.Title': 'Deliverable {0}'.format(id_),
+                'System.WorkItemType': 'Deliverable',
+                'System.AreaPath': '{0}\\Area {1}'.format(project_name, index % 10),
+                'System.IterationPath': project_name,
+                'System.Tags': rnd.choice(['Prog Deliverable L1', 'Prog Deliverable L2']),
+                'System.State': 'New',
+                'Custom.GreenStartDate': format_date(green_start),
+                'Custom.GreenEndDate': format_date(green_start + datetime.timedelta(days=rnd.randint(7, 180))),
+                'Custom.RedStartDate': format_date(red_start),
+                'Custom.RedEndDate': format_date(red_start + datetime.timedelta(days=rnd.randint(14, 270))),
+            }
+
+            revisions = []
+            changed_date = created
+            percent = 0
+            while changed_date < today:
+                fields = dict(fields, **{
+                    'System.Rev': len(revisions) + 1,
+                    'System.ChangedDate': format_date(changed_date),
+                    'System.State': 'Closed' if percent >= 100 else ('Active' if percent else 'New'),
+                })
+                if revisions:
+                    fields['Custom.ProgressPercentageComplete'] = float(percent)
+                revisions.append(fields)
+                if percent >= 100:
+                    break
+                percent = min(100, percent + rnd.choice([0, 5, 10, 25]))
+                changed_date += datetime.timedelta(days=rnd.randint(3, 45), seconds=rnd.randint(0, 86399))
+
+            self.ids.append(id_)
+            self._revisions[id_] = revisions
+            self._changed_dates[id_] = [parse_date(revision['System.ChangedDate']) for revision in revisions]
+
+        # All revisions ordered by changed date, for the reporting revisions API
+        self._reporting = sorted(((changed_dates, id_, rev) for id_, dates in self._changed_dates.items()
+                                  for rev, changed_dates in enumerate(dates)), key=lambda entry: entry[0])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def revisions(self, id_):
+        return self._revisions.get(id_, [])
+
+    def as_of(self, id_, as_of_date=None):
+        """
+        :return: Fields of the latest revision of the Work Item changed on or before as_of_date,
+                 None if the Work Item did not exist yet
+        """
+        revisions = self._revisions.get(id_)
+        if not revisions:
+            return None
+        if as_of_date is None:
+            return revisions[-1]
+        position = bisect.bisect_right(self._changed_dates[id_], as_of_date)
+        return revisions[position - 1] if position else None
+
+    def reporting_page(self, start, size=REPORTING_PAGE_SIZE):
+        """
+        :return: Revisions in changed date order from start, the next start, and whether it is the last page
+        """
+        page = self._reporting[start:start + size]
+        next_start = start + len(page)
+        return [self._revisions[id_][rev] for _, id_, rev in page], next_start, next_start >= len(self._reporting)
+
+
+class Stats:
+    """Request counters of the mock server, per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.throttled = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.endpoints = {}
+            self.statuses = {}
+
+    def add(self, endpoint, status, bytes_received, bytes_sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += bytes_received
+            self.bytes_sent += bytes_sent
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            if status == 429:
+                self.throttled += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled, 'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent, 'endpoints': dict(self.endpoints), 'statuses': dict(self.statuses)}
+
+
+class MockDevOpsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_OPTIONS(self):
+        self._handle('OPTIONS')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        endpoint = self._get_endpoint(method, parts)
+
+        # Benchmark control endpoints are not counted, delayed or throttled
+        if endpoint == 'bench.stats':
+            return self._send(200, self.server.stats.to_dict())
+        if endpoint == 'bench.reset':
+            self.server.stats.reset()
+            return self._send(200, {})
+
+        server = self.server
+        delay = server.latency + server.random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if server.throttle_rate and endpoint != 'options' and server.random.random() < server.throttle_rate:
+            status, payload = 429, {'message': 'Request was blocked due to exceeding usage of resource'}
+            headers = {'Retry-After': '0'}
+        else:
+            headers = {}
+            try:
+                status, payload = self._dispatch(endpoint, parts, query, json.loads(body) if body else None)
+            except (KeyError, ValueError) as err:
+                status, payload = 400, {'message': str(err)}
+
+        sent = self._send(status, payload, headers)
+        server.stats.add(endpoint or 'unknown', status, len(body), sent)
+
+    @staticmethod
+    def _get_endpoint(method, parts):
+        if parts[-2:] == ['_bench', 'stats']:
+            return 'bench.stats'
+        if parts[-2:] == ['_bench', 'reset']:
+            return 'bench.reset'
+        if method == 'OPTIONS':
+            return 'options'
+        if '_apis' not in parts:
+            return None
+        route = parts[parts.index('_apis') + 1:]
+        if route[:1] == ['ResourceAreas']:
+            return 'resourceareas'
+        if route[:1] == ['projects']:
+            return 'projects'
+        if route[:2] == ['wit', 'wiql']:
+            return 'wiql'
+        if route[:2] == ['wit', 'workitemsbatch'] or route[:2] == ['wit', 'workItemsBatch']:
+            return 'workitemsbatch'
+        if route[:3] == ['wit', 'reporting', 'workItemRevisions']:
+            return 'reporting.revisions'
+        if route[:2] == ['wit', 'workItems'] and route[3:4] == ['revisions']:
+            return 'revisions'
+        if route[:2] == ['wit', 'workItems'] or route[:2] == ['wit', 'workitems']:
+            return 'workitems'
+        return None
+
+    def _dispatch(self, endpoint, parts, query, body):
+        portfolio = self.server.portfolio
+        route = parts[parts.index('_apis') + 1:] if '_apis' in parts else []
+
+        if endpoint == 'options':
+            return 200, {'count': len(RESOURCE_LOCATIONS), 'value': RESOURCE_LOCATIONS}
+
+        if endpoint == 'resourceareas':
+            # Empty for on premises servers, the clients then use the base URL
+            return 200, {'count': 0, 'value': []}
+
+        if endpoint == 'projects':
+            return 200, {'count': 1, 'value': [{'id': 'bench', 'name': portfolio.project_name}]}
+
+        if endpoint == 'wiql':
+            ids = portfolio.ids
+            if '$top' in query:
+                ids = ids[:int(query['$top'])]
+            return 200, {'queryType': 'flat', 'queryResultType': 'workItem',
+                         'workItems': [{'id': id_} for id_ in ids]}
+
+        if endpoint == 'workitems':
+            if len(route) > 2:
+                ids = [int(route[2])]
+            else:
+                ids = [int(id_) for id_ in query['ids'].split(',')]
+            fields = query['fields'].split(',') if query.get('fields') else None
+            as_of_date = parse_date(query['asOf']) if query.get('asOf') else None
+            return self._get_work_items(ids, fields, as_of_date, query.get('errorPolicy'))
+
+        if endpoint == 'workitemsbatch':
+            as_of_date = parse_date(body['asOf']) if body.get('asOf') else None
+            return self._get_work_items([int(id_) for id_ in body['ids']], body.get('fields'), as_of_date,
+                                        body.get('errorPolicy'))
+
+        if endpoint == 'revisions':
+            revisions = portfolio.revisions(int(route[2]))
+            skip = int(query.get('$skip', 0))
+            top = int(query.get('$top', MAX_BATCH_SIZE))
+            page = [self._work_item(revision) for revision in revisions[skip:skip + top]]
+            return 200, {'count': len(page), 'value': page}
+
+        if endpoint == 'reporting.revisions':
+            fields = query['fields'].split(',') if query.get('fields') else None
+            page, next_start, is_last = portfolio.reporting_page(int(query.get('continuationToken') or 0))
+            return 200, {'values': [self._work_item(revision, fields) for revision in page],
+                         'continuationToken': str(next_start), 'isLastBatch': is_last}
+
+        return 404, {'message': 'Unknown resource ' + '/'.join(parts)}
+
+    def _get_work_items(self, ids, fields, as_of_date, error_policy):
+        if len(ids) > MAX_BATCH_SIZE:
+            return 400, {'message': 'The maximum number of work items is {0}'.format(MAX_BATCH_SIZE)}
+
+        work_items = []
+        for id_ in ids:
+            revision = self.server.portfolio.as_of(id_, as_of_date)
+            if revision is None and (error_policy or '').lower() != 'omit':
+                return 404, {'message': 'TF401232: Work item {0} does not exist'.format(id_)}
+            work_items.append(self._work_item(revision, fields) if revision is not None else None)
+        return 200, {'count': len(work_items), 'value': work_items}
+
+    @staticmethod
+    def _work_item(revision, fields=None):
+        return {'id': revision['System.Id'], 'rev': revision['System.Rev'],
+                'fields': {name: value for name, value in revision.items() if fields is None or name in fields}}
+
+    def _send(self, status, payload, headers=None):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+        return len(content)
+
+
+def create_server(portfolio, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, throttle_rate=0.0, seed=1):
+    """
+    :param portfolio: Work Items to serve
+    :param latency_ms: Delay added to every request
+    :param jitter_ms: Random variation of the delay, plus or minus
+    :param throttle_rate: Fraction of the requests answered with 429 Too Many Requests
+    :return: Server, not started. server.server_address gives the port when 0 was given.
+    """
+    server = ThreadingHTTPServer((host, port), MockDevOpsHandler)
+    server.daemon_threads = True
+    server.portfolio = portfolio
+    server.latency = latency_ms / 1000.0
+    server.jitter = jitter_ms / 1000.0
+    server.throttle_rate = throttle_rate
+    server.random = random.Random(seed)
+    server.stats = Stats()
+    return server
+
+
+def params():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--host", dest="host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    parser.add_option("--port", dest="port", type="int", default=0, help="Port to listen on (default any free port)")
+    parser.add_option("--items", dest="items", type="int", default=1000, help="Number of Work Items (default 1000)")
+    parser.add_option("--weeks", dest="weeks", type="int", default=52,
+                      help="Weeks of history before today (default 52)")
+    parser.add_option("--start-date", dest="start_date",
+                      help="Project start date, YYYY-MM-DD (default today minus --weeks)")
+    parser.add_option("--latency", dest="latency", type="float", default=0, help="Latency per request in ms")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0, help="Latency jitter in ms, plus or minus")
+    parser.add_option("--throttle-rate", dest="throttle_rate", type="float", default=0.0,
+                      help="Fraction of requests answered with 429 (default 0)")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="Seed of the generated portfolio")
+    (options, args) = parser.parse_args()
+
+    start_date = None
+    if options.start_date:
+        start_date = datetime.datetime.strptime(options.start_date, '%Y-%m-%d')
+    portfolio = Portfolio(items=options.items, start_date=start_date, weeks=options.weeks, seed=options.seed)
+    server = create_server(portfolio, options.host, options.port, options.latency, options.jitter,
+                           options.throttle_rate, options.seed)
+
+    # First line of output is read by the benchmark harness to find the port
+    print("Listening on http://{0}:{1}".format(*server.server_address), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    params()
@@ -0,0 +1,245 @@
+"""
+End-to-end benchmark of the extractor against the local mock Azure DevOps server.
+
+Starts bench/mock_devops.py, then runs runner.main once per actuals mode and repeat, each in a fresh
+process and working directory, so every run starts with a cold response cache and its own peak RSS.
+Wall time, request count, bytes transferred, peak RSS and rows per second of every run are written
+to a JSON file, to compare before and after a change to the extractor.
+
+Usage:
+    $ python bench/run_benchmark.py --items 2000 --weeks 52 --latency 50 --jitter 20 --modes batch,history
+"""
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from optparse import OptionParser, SUPPRESS_HELP
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+FIELDS_ARRAY = ["System.Id", "Custom.GreenStartDate", "Custom.RedStartDate", "Custom.GreenEndDate",
+                "Custom.RedEndDate", "Custom.ProgressPercentageComplete", "System.WorkItemType", "System.Title",
+                "System.State", "System.AreaPath", "System.IterationPath", "System.ChangedDate", "System.Tags"]
+
+
+def get_peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_project_dates(weeks, future_weeks):
+    """Project starting on the Monday `weeks` weeks before this week, ending `future_weeks` weeks after it"""
+    today = datetime.date.today()
+    this_monday = today - datetime.timedelta(days=today.weekday())
+    start_date = this_monday - datetime.timedelta(weeks=weeks)
+    end_date = this_monday + datetime.timedelta(weeks=future_weeks)
+    return start_date, end_date
+
+
+def start_mock_server(options, start_date):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_devops.py"), "--port", "0",
+               "--items", str(options.items), "--start-date", str(start_date),
+               "--latency", str(options.latency), "--jitter", str(options.jitter),
+               "--throttle-rate", str(options.throttle_rate), "--seed", str(options.seed)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = server.stdout.readline().strip()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError("Mock server failed to start: " + line)
+    return server, line[len("Listening on "):]
+
+
+def server_request(url, path, method='GET'):
+    request = urllib.request.Request(url + path, data=b'' if method == 'POST' else None, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode())
+
+
+def run_once(options, url, start_date, end_date, actuals_mode, verbose=False):
+    """Run the extractor in a child process against the mock server"""
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        conf = {
+            "project_name": "Bench",
+            "project_start_date": str(start_date),
+            "project_end_date": str(end_date),
+            "url": url,
+            "pat": "bench",
+            "test_run": False,
+            "test_work_item_id": 1000,
+            "future_actuals_are_None": False,
+            "fields_array": FIELDS_ARRAY,
+            "actuals_mode": actuals_mode,
+            "output_format": options.output_format,
+        }
+        if options.max_concurrency is not None:
+            conf["max_concurrency"] = options.max_concurrency
+        config_file = os.path.join(work_dir, "bench-config.json")
+        with open(config_file, 'w') as config_fp:
+            json.dump(conf, config_fp, indent=4)
+
+        result_file = os.path.join(work_dir, "result.json")
+        env = dict(os.environ, AZURE_DEVOPS_CACHE_DIR=os.path.join(work_dir, "sdk-cache"))
+        output = None if verbose else subprocess.DEVNULL
+
+        server_request(url, "/_bench/reset", method='POST')
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--child", config_file, result_file],
+                              cwd=work_dir, env=env, stdout=output, stderr=output)
+        stats = server_request(url, "/_bench/stats")
+
+        with open(result_file) as result_fp:
+            result = json.load(result_fp)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result.update({
+        'actuals_mode': actuals_mode,
+        'requests': stats['requests'],
+        'throttled': stats['throttled'],
+        'bytes_sent': stats['bytes_received'],
+        'bytes_received': stats['bytes_sent'],
+        'endpoints': stats['endpoints'],
+        'statuses': stats['statuses'],
+        'rows_per_second': round(result['rows'] / result['wall_time'], 1) if result['wall_time'] else None,
+    })
+    return result
+
+
+def run_child(config_file, result_file):
+    """Child process: run the extractor in the current directory and save the measures of the run"""
+    sys.path.insert(0, SRC_DIR)
+    import_start = time.time()
+    import runner
+    from utils import get_output_file_name, read_df
+    import_time = time.time() - import_start
+
+    with open(config_file) as config_fp:
+        output_format = json.load(config_fp)["output_format"]
+
+    start = time.time()
+    runner.main(token="bench", config_file=config_file)
+    wall_time = time.time() - start
+
+    df_tracking = read_df(get_output_file_name(runner.__OUT_FILE__, output_format), output_format)
+    with open(result_file, 'w') as result_fp:
+        json.dump({
+            'wall_time': round(wall_time, 3),
+            'import_time': round(import_time, 3),
+            'rows': len(df_tracking) if df_tracking is not None else 0,
+            'peak_rss_kb': get_peak_rss_kb(),
+        }, result_fp)
+
+
+def summarize(runs):
+    summary = {}
+    for actuals_mode in dict.fromkeys(run['actuals_mode'] for run in runs):
+        mode_runs = [run for run in runs if run['actuals_mode'] == actuals_mode]
+        summary[actuals_mode] = {
+            'runs': len(mode_runs),
+            'wall_time_median': round(statistics.median(run['wall_time'] for run in mode_runs), 3),
+            'wall_time_min': min(run['wall_time'] for run in mode_runs),
+            'requests_median': statistics.median(run['requests'] for run in mode_runs),
+            'bytes_received_median': statistics.median(run['bytes_received'] for run in mode_runs),
+            'peak_rss_kb_max': max((run['peak_rss_kb'] or 0) for run in mode_runs) or None,
+            'rows': mode_runs[0]['rows'],
+        }
+    return summary
+
+
+def params():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--items", dest="items", type="int", default=500, help="Number of Work Items (default 500)")
+    parser.add_option("--weeks", dest="weeks", type="int", default=26,
+                      help="Weeks of the project before this week (default 26)")
+    parser.add_option("--future-weeks", dest="future_weeks", type="int", default=4,
+                      help="Weeks of the project after this week (default 4)")
+    parser.add_option("--latency", dest="latency", type="float", default=20, help="Latency per request in ms")
+    parser.add_option("--jitter", dest="jitter", type="float", default=5, help="Latency jitter in ms, plus or minus")
+    parser.add_option("--throttle-rate", dest="throttle_rate", type="float", default=0.0,
+                      help="Fraction of requests answered with 429 (default 0)")
+    parser.add_option("--modes", dest="modes", default="batch",
+                      help="Comma separated actuals modes to run (default batch)")
+    parser.add_option("--max-concurrency", dest="max_concurrency", type="int",
+                      help="max_concurrency of the runs (default from the extractor)")
+    parser.add_option("--format", dest="output_format", default="csv", help="Output format of the runs (default csv)")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3, help="Runs per actuals mode (default 3)")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="Seed of the generated portfolio")
+    parser.add_option("-o", "--output", dest="output", help="Results file (default bench/results/<timestamp>.json)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="Show the output of the runs")
+    parser.add_option("--child", dest="child", nargs=2, help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        run_child(*options.child)
+        return
+
+    start_date, end_date = get_project_dates(options.weeks, options.future_weeks)
+    server, url = start_mock_server(options, start_date)
+    runs = []
+    try:
+        for actuals_mode in options.modes.split(','):
+            for repeat in range(options.repeat):
+                result = run_once(options, url, start_date, end_date, actuals_mode.strip(), options.verbose)
+                print("{0:<8} run {1}: {2:8.2f}s {3:7} requests {4:>10} bytes {5:>8} KB RSS {6:>10} rows/s".format(
+                    result['actuals_mode'], repeat + 1, result['wall_time'], result['requests'],
+                    result['bytes_received'], result['peak_rss_kb'] or '-', result['rows_per_second']))
+                runs.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'items': options.items, 'weeks': options.weeks, 'future_weeks': options.future_weeks,
+            'project_start_date': str(start_date), 'project_end_date': str(end_date),
+            'latency_ms': options.latency, 'jitter_ms': options.jitter, 'throttle_rate': options.throttle_rate,
+            'max_concurrency': options.max_concurrency, 'output_format': options.output_format,
+            'repeat': options.repeat, 'seed': options.seed,
+        },
+        'summary': summarize(runs),
+        'runs': runs,
+    }
+
+    output = options.output
+    if output is None:
+        output = os.path.join(RESULTS_DIR, "benchmark-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    output_dir = os.path.dirname(output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(output, 'w') as output_fp:
+        json.dump(results, output_fp, indent=2)
+    print("Results written to", output)
+
+
+if __name__ == '__main__':
+
+    params()
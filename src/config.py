@@ -16,7 +16,20 @@ CONFIG_KEYS = [
     'test_run',
     'test_work_item_id',
     'future_actuals_are_None',
-    'fields_array'
+    'fields_array',
+    'actuals_mode',
+    'revision_store_file',
+    'max_concurrency',
+    'response_cache_file',
+    'response_cache_max_entries',
+    'output_format',
+    'incremental',
+    'http_metrics',
+    'http_capture_file',
+    'http_capture_sample_rate',
+    'http_capture_max_body_bytes',
+    'http_capture_max_file_bytes',
+    'http_capture_max_files'
 ]
 
 
@@ -1,8 +1,21 @@
 """
-HTTP logger hook (for dumping the request/response cycle).
+HTTP logger hook (for dumping or capturing the request/response cycle, and collecting request metrics).
 """
 from contextlib import contextmanager
+from urllib.parse import urlparse
+import gzip
 import json
+import logging
+import math
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
 
 
 ###
@@ -11,6 +24,8 @@ import json
 
 _enabled_stack = [False]
 target = None
+metrics = None
+capture = None
 
 
 def push_state(enabled):
@@ -110,8 +125,417 @@ def log_request(response, file):
     json.dump(data, file, indent=4)
 
 
+###
+# Request metrics
+###
+
+THROTTLING_HEADERS = [
+    "Retry-After",
+    "X-RateLimit-Resource",
+    "X-RateLimit-Delay",
+    "X-RateLimit-Limit",
+    "X-RateLimit-Remaining",
+    "X-RateLimit-Reset",
+]
+
+LATENCY_QUANTILES = [50, 95, 99]
+
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})$')
+
+
+def get_endpoint(method, url):
+    """Endpoint of a request, with the IDs and anything before _apis (organization, project, team) left out.
+    e.g. GET /_apis/wit/workitems/{id}/revisions
+    """
+    segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    if '_apis' in segments:
+        segments = segments[segments.index('_apis'):]
+    segments = ['{id}' if _ID_SEGMENT.match(segment) else segment.lower() for segment in segments]
+    return "{0} /{1}".format(method, '/'.join(segments))
+
+
+def _percentile(sorted_values, percent):
+    """Nearest rank percentile"""
+    if not sorted_values:
+        return None
+    return round(sorted_values[max(0, int(math.ceil(percent / 100.0 * len(sorted_values))) - 1)], 6)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestMetrics:
+    """Request counts, latencies, response sizes, status codes, retries and throttling headers per endpoint.
+    Shared by all the clients and threads of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _get_endpoint_metrics(self, endpoint):
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = {
+                'requests': 0,
+                'latencies': [],
+                'response_bytes': 0,
+                'statuses': {},
+                'retries': 0,
+                'throttled': 0,
+                'throttling_headers': {},
+                'retry_after_max': None,
+                'rate_limit_delay_total': 0.0,
+                'rate_limit_remaining_min': None,
+            }
+        return self._endpoints[endpoint]
+
+    def record(self, response):
+        """Record a response, reading its body if not read yet"""
+        body_start = time.time()
+        response_bytes = len(response.content or b'')
+        latency = response.elapsed.total_seconds() + (time.time() - body_start)
+
+        # Retries made by urllib3 before this response, throttled ones included
+        retry_history = []
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None:
+            retry_history = retries.history or ()
+
+        throttling_headers = {name: response.headers[name] for name in THROTTLING_HEADERS
+                              if name in response.headers}
+
+        endpoint = get_endpoint(response.request.method, response.request.url)
+        with self._lock:
+            endpoint_metrics = self._get_endpoint_metrics(endpoint)
+            endpoint_metrics['requests'] += 1
+            endpoint_metrics['latencies'].append(latency)
+            endpoint_metrics['response_bytes'] += response_bytes
+            status = str(response.status_code)
+            endpoint_metrics['statuses'][status] = endpoint_metrics['statuses'].get(status, 0) + 1
+            endpoint_metrics['retries'] += len(retry_history)
+            endpoint_metrics['throttled'] += sum(1 for retry in retry_history if retry.status == 429)
+            if response.status_code == 429:
+                endpoint_metrics['throttled'] += 1
+
+            for name, value in throttling_headers.items():
+                endpoint_metrics['throttling_headers'][name] = endpoint_metrics['throttling_headers'].get(name, 0) + 1
+            retry_after = _to_float(throttling_headers.get("Retry-After"))
+            if retry_after is not None:
+                endpoint_metrics['retry_after_max'] = max(endpoint_metrics['retry_after_max'] or 0, retry_after)
+            delay = _to_float(throttling_headers.get("X-RateLimit-Delay"))
+            if delay is not None:
+                endpoint_metrics['rate_limit_delay_total'] += delay
+            remaining = _to_float(throttling_headers.get("X-RateLimit-Remaining"))
+            if remaining is not None and (endpoint_metrics['rate_limit_remaining_min'] is None
+                                          or remaining < endpoint_metrics['rate_limit_remaining_min']):
+                endpoint_metrics['rate_limit_remaining_min'] = remaining
+
+    def to_dict(self):
+        """
+        :return: Metrics per endpoint, with latency percentiles in seconds instead of the latencies
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, endpoint_metrics in sorted(self._endpoints.items()):
+                latencies = sorted(endpoint_metrics['latencies'])
+                summary = {key: value for key, value in endpoint_metrics.items() if key != 'latencies'}
+                summary['statuses'] = dict(endpoint_metrics['statuses'])
+                summary['throttling_headers'] = dict(endpoint_metrics['throttling_headers'])
+                summary['latency_total'] = round(sum(latencies), 6)
+                for quantile in LATENCY_QUANTILES:
+                    summary['latency_p{0}'.format(quantile)] = _percentile(latencies, quantile)
+                endpoints[endpoint] = summary
+
+        totals = {key: sum(endpoint_metrics[key] for endpoint_metrics in endpoints.values())
+                  for key in ('requests', 'response_bytes', 'retries', 'throttled', 'latency_total')}
+        return {'endpoints': endpoints, 'total': totals}
+
+    def write_json(self, filename):
+        _write_atomic(filename, json.dumps(self.to_dict(), indent=4, sort_keys=True))
+
+    def write_prometheus(self, filename):
+        """Prometheus text exposition format, for the node exporter textfile collector"""
+        metrics_dict = self.to_dict()['endpoints']
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ",".join('{0}="{1}"'.format(key, _escape_label(label_value))
+                                      for key, label_value in labels)
+                lines.append("{0}{1}{{{2}}} {3}".format(name, suffix, label_text, _format_value(value)))
+
+        add("devops_http_requests_total", "counter", "HTTP requests by endpoint and status code.",
+            [("", [("endpoint", endpoint), ("status", status)], count)
+             for endpoint, endpoint_metrics in metrics_dict.items()
+             for status, count in sorted(endpoint_metrics['statuses'].items())])
+        add("devops_http_request_duration_seconds", "summary", "HTTP request latency by endpoint.",
+            [("", [("endpoint", endpoint), ("quantile", quantile / 100.0)],
+              endpoint_metrics['latency_p{0}'.format(quantile)])
+             for endpoint, endpoint_metrics in metrics_dict.items() for quantile in LATENCY_QUANTILES]
+            + [(suffix, [("endpoint", endpoint)], endpoint_metrics[key])
+               for endpoint, endpoint_metrics in metrics_dict.items()
+               for suffix, key in (("_sum", 'latency_total'), ("_count", 'requests'))])
+        add("devops_http_response_bytes_total", "counter", "HTTP response body bytes by endpoint.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['response_bytes'])
+             for endpoint, endpoint_metrics in metrics_dict.items()])
+        add("devops_http_retries_total", "counter", "HTTP requests retried by endpoint.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['retries'])
+             for endpoint, endpoint_metrics in metrics_dict.items()])
+        add("devops_http_throttled_total", "counter", "HTTP 429 responses by endpoint, retried ones included.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['throttled'])
+             for endpoint, endpoint_metrics in metrics_dict.items()])
+        add("devops_http_throttling_headers_total", "counter", "HTTP responses with a throttling header.",
+            [("", [("endpoint", endpoint), ("header", header)], count)
+             for endpoint, endpoint_metrics in metrics_dict.items()
+             for header, count in sorted(endpoint_metrics['throttling_headers'].items())])
+        add("devops_http_retry_after_seconds_max", "gauge", "Largest Retry-After header by endpoint.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['retry_after_max'])
+             for endpoint, endpoint_metrics in metrics_dict.items()
+             if endpoint_metrics['retry_after_max'] is not None])
+        add("devops_http_rate_limit_delay_seconds_total", "counter", "Sum of the X-RateLimit-Delay headers.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['rate_limit_delay_total'])
+             for endpoint, endpoint_metrics in metrics_dict.items()])
+        add("devops_http_rate_limit_remaining_min", "gauge", "Lowest X-RateLimit-Remaining header by endpoint.",
+            [("", [("endpoint", endpoint)], endpoint_metrics['rate_limit_remaining_min'])
+             for endpoint, endpoint_metrics in metrics_dict.items()
+             if endpoint_metrics['rate_limit_remaining_min'] is not None])
+
+        _write_atomic(filename, "\n".join(lines) + "\n")
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _write_atomic(filename, text):
+    """Write to a temporary file then rename it, so a reader never sees a partial file"""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename + '.tmp', 'w') as metrics_fp:
+        metrics_fp.write(text)
+    os.replace(filename + '.tmp', filename)
+
+
+def enable_metrics():
+    """Start collecting request metrics, if not already
+    :return: The metrics collector of the process
+    """
+    global metrics
+
+    if metrics is None:
+        metrics = RequestMetrics()
+    return metrics
+
+
+###
+# Buffered NDJSON capture
+###
+
+DEFAULT_CAPTURE_SAMPLE_RATE = 1.0
+DEFAULT_CAPTURE_MAX_BODY_BYTES = 4096
+DEFAULT_CAPTURE_MAX_FILE_BYTES = 100 * 1024 * 1024
+DEFAULT_CAPTURE_MAX_FILES = 10
+DEFAULT_CAPTURE_QUEUE_SIZE = 10000
+
+_CAPTURE_STOP = object()
+
+
+def _truncate(body, max_bytes, encoding=None):
+    """
+    :return: Body as text, cut to max_bytes, and whether it was cut
+    """
+    if body is None:
+        return None, False
+    truncated = max_bytes is not None and len(body) > max_bytes
+    if truncated:
+        body = body[:max_bytes]
+    if isinstance(body, bytes):
+        body = body.decode(encoding or 'utf-8', 'replace')
+    return body, truncated
+
+
+def _rotated_file_name(filename, index):
+    """capture.ndjson.gz -> capture.1.ndjson.gz"""
+    root, extension = os.path.splitext(filename)
+    if extension == '.gz':
+        root, inner_extension = os.path.splitext(root)
+        extension = inner_extension + extension
+    return "{0}.{1}{2}".format(root, index, extension)
+
+
+class CaptureWriter:
+    """Captures sampled request/response cycles as compact NDJSON, gzip compressed.
+
+    The hook only builds the record and puts it on a bounded queue. A background thread serializes and
+    writes the records, and rotates the file once max_file_bytes of NDJSON are written to it, keeping
+    max_files files. Records are dropped rather than slowing the requests down when the queue is full.
+    """
+
+    def __init__(self, filename, sample_rate=DEFAULT_CAPTURE_SAMPLE_RATE,
+                 max_body_bytes=DEFAULT_CAPTURE_MAX_BODY_BYTES, max_file_bytes=DEFAULT_CAPTURE_MAX_FILE_BYTES,
+                 max_files=DEFAULT_CAPTURE_MAX_FILES, queue_size=DEFAULT_CAPTURE_QUEUE_SIZE):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._filename = filename
+        self._sample_rate = sample_rate
+        self._max_body_bytes = max_body_bytes
+        self._max_file_bytes = max_file_bytes
+        self._max_files = max(1, max_files)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._file_bytes = 0
+        self.captured = 0
+        self.written = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="http-capture", daemon=True)
+        self._thread.start()
+
+    def capture(self, response):
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return
+
+        request = response.request
+        content = response.content or b''
+        request_body, request_truncated = _truncate(request.body, self._max_body_bytes)
+        response_body, response_truncated = _truncate(content, self._max_body_bytes, response.encoding)
+
+        record = {
+            'time': time.time(),
+            'elapsed': response.elapsed.total_seconds(),
+            'request': {
+                'method': request.method,
+                'url': request.url,
+                'headers': _trim_headers(request.headers),
+                'body': request_body,
+                'truncated': request_truncated,
+            },
+            'response': {
+                'status': response.status_code,
+                'url': response.url,
+                'headers': _trim_headers(response.headers),
+                'size': len(content),
+                'body': response_body,
+                'truncated': response_truncated,
+            },
+        }
+
+        try:
+            self._queue.put_nowait(record)
+            self.captured += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is _CAPTURE_STOP:
+                break
+            try:
+                self._write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+                self.written += 1
+            except (OSError, TypeError, ValueError) as ex:
+                logger.warning("Failed to write HTTP capture record: %s", ex)
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line):
+        if self._file is not None and self._file_bytes + len(line) > self._max_file_bytes and self._file_bytes:
+            self._rotate()
+        if self._file is None:
+            self._file = gzip.open(self._filename, 'wb')
+            self._file_bytes = 0
+        self._file.write(line)
+        self._file_bytes += len(line)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        # capture.ndjson.gz becomes capture.1.ndjson.gz, capture.1.ndjson.gz becomes capture.2.ndjson.gz ...
+        oldest = _rotated_file_name(self._filename, self._max_files - 1)
+        if self._max_files == 1:
+            os.remove(self._filename)
+            return
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for index in range(self._max_files - 2, 0, -1):
+            rotated = _rotated_file_name(self._filename, index)
+            if os.path.exists(rotated):
+                os.replace(rotated, _rotated_file_name(self._filename, index + 1))
+        os.replace(self._filename, _rotated_file_name(self._filename, 1))
+
+    def close(self):
+        """Write the queued records and close the file"""
+        self._queue.put(_CAPTURE_STOP)
+        self._thread.join()
+
+    def stats(self):
+        return {'captured': self.captured, 'written': self.written, 'dropped': self.dropped}
+
+
+_capture_users = 0
+_capture_lock = threading.Lock()
+
+
+def start_capture(filename, **kwargs):
+    """Start capturing to filename, if not already. Runs sharing the process share the capture.
+    :return: The capture writer of the process
+    """
+    global capture, _capture_users
+
+    with _capture_lock:
+        if capture is None:
+            capture = CaptureWriter(filename, **kwargs)
+            push_state(True)
+        _capture_users += 1
+        return capture
+
+
+def stop_capture():
+    """Stop capturing once the last run using the capture stops it
+    :return: Statistics of the capture, None if it is still used by another run
+    """
+    global capture, _capture_users
+
+    with _capture_lock:
+        if capture is None:
+            return None
+        _capture_users -= 1
+        if _capture_users > 0:
+            return None
+        writer = capture
+        capture = None
+        pop_state()
+    writer.close()
+    return writer.stats()
+
+
 def requests_hook(response, *args, **kwargs):
     global target
 
-    if logging_enabled() and target is not None:
-        log_request(response, target)
\ No newline at end of file
+    if metrics is not None:
+        metrics.record(response)
+
+    if logging_enabled():
+        if capture is not None:
+            capture.capture(response)
+        if target is not None:
+            log_request(response, target)
\ No newline at end of file
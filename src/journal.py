@@ -0,0 +1,91 @@
+"""
+Run journal, to checkpoint completed weeks of a run and resume an interrupted run.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_run_hash(config, current_week, ids):
+    """
+    :param config: Config of the run, without the PAT
+    :param current_week: Today, as used for the actuals of the current and future weeks
+    :param ids: Work Item IDs of the extract
+    :return: Hash identifying the run, a journal can only be resumed by a run with the same hash
+    """
+    run = {
+        'config': config,
+        'current_week': str(current_week),
+        'ids': sorted(int(id_) for id_ in ids),
+    }
+    return hashlib.sha256(json.dumps(run, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunJournal:
+    """Append-only NDJSON file of the tracking rows of each completed week.
+    The first line records the hash of the run the journal belongs to.
+    """
+
+    def __init__(self, filename, run_hash, resume=False):
+        self._filename = filename
+        self.completed_weeks = {}
+
+        if resume and os.path.exists(filename):
+            self._load(run_hash)
+
+        if not self.completed_weeks:
+            directory = os.path.dirname(filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(filename, 'w') as journal_fp:
+                journal_fp.write(json.dumps({'run_hash': run_hash}) + '\n')
+
+    def _load(self, run_hash):
+        with open(self._filename) as journal_fp:
+            try:
+                header = json.loads(journal_fp.readline())
+            except ValueError:
+                header = {}
+            if header.get('run_hash') != run_hash:
+                logger.warning("Journal %s belongs to a different run, starting over", self._filename)
+                return
+
+            for line in journal_fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line is incomplete when the run was killed while writing it
+                    logger.warning("Ignoring incomplete journal entry in %s", self._filename)
+                    break
+                report_date = datetime.date.fromisoformat(entry['report_date'])
+                self.completed_weeks[report_date] = [
+                    [id_, datetime.date.fromisoformat(date), green_pct, red_pct, white_pct]
+                    for id_, date, green_pct, red_pct, white_pct in entry['rows']]
+
+        logger.info("Resuming from journal %s with %s completed weeks", self._filename, len(self.completed_weeks))
+
+    def add_week(self, report_date, rows):
+        """
+        :param report_date: Week starting date
+        :param rows: Tracking rows of all the Work Items for the week
+        """
+        entry = {
+            'report_date': report_date.isoformat(),
+            'rows': [[int(id_), date.isoformat(), green_pct, red_pct, white_pct]
+                     for id_, date, green_pct, red_pct, white_pct in rows],
+        }
+        with open(self._filename, 'a') as journal_fp:
+            journal_fp.write(json.dumps(entry) + '\n')
+            journal_fp.flush()
+            os.fsync(journal_fp.fileno())
+        self.completed_weeks[report_date] = rows
+
+    def remove(self):
+        """Remove the journal once the output is written"""
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
@@ -0,0 +1,119 @@
+"""
+Disk-backed cache of historical as of Work Item lookups.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE_CACHE_FILE = "out/cache/responses.db"
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = 1000000
+
+
+def is_cacheable(as_of_date):
+    """A Work Item as of a past date can never change, as of today or later can"""
+    return as_of_date is not None and as_of_date.date() < datetime.datetime.utcnow().date()
+
+
+class ResponseCache:
+    """SQLite cache of Work Item fields keyed by (id, as of date, field set), with LRU eviction
+    once it holds more than max_entries entries.
+    """
+
+    def __init__(self, filename=DEFAULT_RESPONSE_CACHE_FILE, max_entries=DEFAULT_RESPONSE_CACHE_MAX_ENTRIES):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._filename = filename
+        self._max_entries = max_entries
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript("""
+            create table if not exists responses (
+                key text primary key,
+                fields text,
+                last_access real not null
+            );
+            create index if not exists responses_last_access on responses (last_access);
+            """)
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _key(work_item_id, as_of_date, fields):
+        fields_hash = hashlib.sha1(",".join(sorted(fields or [])).encode()).hexdigest()
+        return "{0}|{1}|{2}".format(int(work_item_id), as_of_date.isoformat(), fields_hash)
+
+    def get_many(self, ids, as_of_date, fields):
+        """
+        :return: Dict of Work Item ID to cached fields (None for Work Items omitted by the server),
+                 for the IDs found in the cache
+        """
+        if not is_cacheable(as_of_date):
+            return {}
+
+        keys = {self._key(id_, as_of_date, fields): int(id_) for id_ in ids}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            cursor = self._connection.execute(
+                "select key, fields from responses where key in ({0})".format(",".join("?" * len(chunk))), chunk)
+            for key, cached_fields in cursor:
+                found[keys[key]] = json.loads(cached_fields) if cached_fields is not None else None
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        if found:
+            now = time.time()
+            with self._connection:
+                self._connection.executemany("update responses set last_access = ? where key = ?",
+                                             [(now, self._key(id_, as_of_date, fields)) for id_ in found])
+        return found
+
+    def put_many(self, results, as_of_date, fields):
+        """
+        :param results: Dict of Work Item ID to fields, None for Work Items omitted by the server
+        """
+        if not is_cacheable(as_of_date) or not results:
+            return
+
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "insert or replace into responses (key, fields, last_access) values (?, ?, ?)",
+                [(self._key(id_, as_of_date, fields), json.dumps(id_fields) if id_fields is not None else None, now)
+                 for id_, id_fields in results.items()])
+        self._evict()
+
+    def _evict(self):
+        count = len(self)
+        if count <= self._max_entries:
+            return
+        with self._connection:
+            self._connection.execute(
+                "delete from responses where key in (select key from responses order by last_access limit ?)",
+                (count - self._max_entries,))
+        logger.debug("Evicted %s entries from the response cache", count - self._max_entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def __len__(self):
+        return self._connection.execute("select count(*) from responses").fetchone()[0]
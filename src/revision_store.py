@@ -0,0 +1,88 @@
+"""
+Local store of Work Item revisions, fed incrementally by the reporting work item revisions API.
+"""
+import datetime
+import logging
+import os
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REVISION_STORE_FILE = "out/revisions.db"
+
+
+class RevisionStore:
+    """SQLite store of the Actual (White) percentage of every Work Item revision,
+    along with the watermark (continuation token) of the last sync.
+    """
+
+    def __init__(self, filename=DEFAULT_REVISION_STORE_FILE):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._filename = filename
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript("""
+            create table if not exists revisions (
+                id integer not null,
+                rev integer not null,
+                changed_date text not null,
+                actual_percent integer not null,
+                primary key (id, rev)
+            );
+            create table if not exists sync_state (
+                key text primary key,
+                value text
+            );
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def get_watermark(self):
+        row = self._connection.execute("select value from sync_state where key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def add_revisions(self, revisions, watermark):
+        """
+        :param revisions: List of (id, rev, changed_date, actual_percent) tuples
+        :param watermark: Continuation token to resume the next sync from
+        """
+        # Revisions and watermark are saved together so an interrupted sync resumes where it stopped
+        with self._connection:
+            self._connection.executemany(
+                "insert or replace into revisions (id, rev, changed_date, actual_percent) values (?, ?, ?, ?)",
+                [(int(id_), int(rev), changed_date.isoformat(), int(actual_percent))
+                 for id_, rev, changed_date, actual_percent in revisions])
+            self._connection.execute("insert or replace into sync_state (key, value) values ('watermark', ?)",
+                                     (watermark,))
+
+    def get_changes(self, ids):
+        """
+        :param ids: Work Item IDs
+        :return: Dict of Work Item ID to list of (changed_date, rev, actual_percent) tuples sorted by date
+        """
+        ids = list(dict.fromkeys(int(id_) for id_ in ids))
+        changes = {id_: [] for id_ in ids}
+
+        # Keep well below the SQLite limit on the number of query parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor = self._connection.execute(
+                "select id, rev, changed_date, actual_percent from revisions where id in ({0}) "
+                "order by id, changed_date, rev".format(",".join("?" * len(chunk))), chunk)
+            for id_, rev, changed_date, actual_percent in cursor:
+                changes[id_].append((datetime.datetime.fromisoformat(changed_date), rev, actual_percent))
+
+        return changes
+
+    def __len__(self):
+        return self._connection.execute("select count(*) from revisions").fetchone()[0]
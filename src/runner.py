@@ -34,8 +34,12 @@ from azure.devops.credentials import BasicAuthentication
 from azure.devops.connection import Connection
 from workitem import *
 from config import Config
+from journal import RunJournal, get_run_hash
+import http_logging
 from utils import *
 import time, sys
+import glob
+import threading
 from tqdm import *
 from optparse import OptionParser
 
@@ -44,6 +48,9 @@ __VERSION__ = "1.0.0"
 __CONFIG_FILE__ = "./devops-runner-config.json"
 __OUT_FILE__ = "out/WorkItemTracking.csv"
 __DUMP_FILE__ = "out/WorkItemExtract.csv"
+__JOURNAL_FILE__ = "out/WorkItemTracking.journal"
+__METRICS_FILE__ = "out/HttpMetrics.json"
+__METRICS_PROM_FILE__ = "out/HttpMetrics.prom"
 
 # Create Logs folder is no Exists
 if not os.path.exists("logs"):
@@ -59,7 +66,34 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)-8s %(m
                     datefmt='%a, %d %b %Y %H:%M:%S', filename='logs/run.log', filemode='w')
 
 
-def init(token, config_file=None):
+# Connections shared by all the runs of the process, one per org URL and PAT
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(url, pat):
+    with _connections_lock:
+        if (url, pat) not in _connections:
+            connection = Connection(
+                base_url=url,
+                creds=BasicAuthentication('PAT', pat),
+                user_agent=__TASK__ + '/' + __VERSION__)
+
+            # monkey-patch the get_client method to attach our hook
+            _get_client = connection.get_client
+
+            def get_client_with_hook(*args, **kwargs):
+                client = _get_client(*args, **kwargs)
+                if http_logging.requests_hook not in client.config.hooks:
+                    client.config.hooks.append(http_logging.requests_hook)
+                return client
+
+            connection.get_client = get_client_with_hook
+            _connections[(url, pat)] = connection
+        return _connections[(url, pat)]
+
+
+def init(token, config_file=None, project_name=None, output_dir=None):
     if config_file is None:
         conf = Config(filename=__CONFIG_FILE__).config
     else:
@@ -73,14 +107,17 @@ def init(token, config_file=None):
     else:
         pat = conf['pat']
 
+    # Project discovered from the org, when the config applies to all projects
+    if project_name is not None:
+        conf = dict(conf, project_name=project_name)
+
     context = SimpleNamespace()
     context.runner_cache = SimpleNamespace()
+    context.config = {key: value for key, value in conf.items() if key != 'pat'}
+    context.output_dir = output_dir or os.path.dirname(__OUT_FILE__)
 
-    # Setup the connection
-    context.connection = Connection(
-        base_url=conf['url'],
-        creds=BasicAuthentication('PAT', pat),
-        user_agent=__TASK__ + '/' + __VERSION__)
+    # Setup the connection, shared with the other runs against the same org
+    context.connection = get_connection(conf['url'], pat)
     context.project_name = conf['project_name']
     context.project_start_date = conf['project_start_date']
     context.project_end_date = conf['project_end_date']
@@ -89,6 +126,22 @@ def init(token, config_file=None):
     context.test_work_item_id = conf['test_work_item_id']
     context.future_actuals_are_None = conf['future_actuals_are_None']
     context.fields_array = conf['fields_array']
+    context.actuals_mode = conf.get('actuals_mode', 'batch')
+    context.revision_store_file = conf.get('revision_store_file', os.path.join(context.output_dir, 'revisions.db'))
+    context.max_concurrency = conf.get('max_concurrency', 8)
+    context.response_cache_file = conf.get('response_cache_file',
+                                           os.path.join(context.output_dir, 'cache', 'responses.db'))
+    context.response_cache_max_entries = conf.get('response_cache_max_entries', 1000000)
+    context.output_format = conf.get('output_format', 'csv')
+    context.incremental = conf.get('incremental', False)
+    context.http_metrics = conf.get('http_metrics', False)
+    context.http_capture_file = conf.get('http_capture_file')
+    context.http_capture_sample_rate = conf.get('http_capture_sample_rate', http_logging.DEFAULT_CAPTURE_SAMPLE_RATE)
+    context.http_capture_max_body_bytes = conf.get('http_capture_max_body_bytes',
+                                                   http_logging.DEFAULT_CAPTURE_MAX_BODY_BYTES)
+    context.http_capture_max_file_bytes = conf.get('http_capture_max_file_bytes',
+                                                   http_logging.DEFAULT_CAPTURE_MAX_FILE_BYTES)
+    context.http_capture_max_files = conf.get('http_capture_max_files', http_logging.DEFAULT_CAPTURE_MAX_FILES)
 
     return context
 
@@ -98,25 +151,100 @@ def params():
     # Parse Options
     usage = "usage: %prog [options] arg1 arg2"
     parser = OptionParser(usage=usage)
-    parser.add_option("-c", "--conf", dest="config_file",
-                      help="Config File Name", metavar="FILE")
+    parser.add_option("-c", "--conf", dest="config_files",
+                      action="append",
+                      help="Config File Name, or directory of config files. Can be given more than once",
+                      metavar="FILE")
     parser.add_option("-p", "--passwd", dest="pat",
                       action="store", type="string",
                       help="Personal Access Token for Azure DevOps Repo")
+    parser.add_option("-f", "--format", dest="output_format",
+                      choices=OUTPUT_FORMATS,
+                      help="Output file format: " + ", ".join(OUTPUT_FORMATS) + " (default from config, or csv)")
+    parser.add_option("-i", "--incremental", dest="incremental",
+                      action="store_true", default=None,
+                      help="Only compute the weeks after the last complete week of the existing tracking output")
+    parser.add_option("-r", "--resume", dest="resume",
+                      action="store_true", default=False,
+                      help="Resume an interrupted run, skipping the weeks already completed")
+    parser.add_option("-m", "--metrics", dest="metrics",
+                      action="store_true", default=None,
+                      help="Write HTTP request metrics to HttpMetrics.json and HttpMetrics.prom in the output folder")
+    parser.add_option("--capture", dest="output_path",
+                      action="store", type="string",
+                      help="Capture the HTTP requests and responses to a gzip compressed NDJSON file",
+                      metavar="FILE")
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      action="store", type="int", default=4,
+                      help="Number of projects processed at a time, when running several (default 4)")
     (options, args) = parser.parse_args()
 
-    if options.config_file and options.pat:
-        # print("reading %s..." % options.filename)
-        main(config_file=options.config_file, token=options.pat)
-    elif options.config_file:
-        main(config_file=options.config_file, token='')
-    elif options.pat:
-        main(token=options.pat)
-    elif len(args) != 1:
-        main(token='')
-
-
-def main(token, config_file=None, output_path=None):
+    if options.config_files or options.pat or len(args) != 1:
+        token = options.pat or ''
+        runs = get_runs(get_config_files(options.config_files), token)
+
+        def run(config_run):
+            config_file, project_name, output_dir = config_run
+            main(token=token, config_file=config_file, output_format=options.output_format,
+                 incremental=options.incremental, resume=options.resume, project_name=project_name,
+                 output_dir=output_dir, metrics=options.metrics, output_path=options.output_path)
+
+        # Projects run concurrently in this process, sharing one connection per org
+        for _ in bounded_map(run, runs, max_concurrency=options.jobs):
+            pass
+
+
+def get_config_files(config_files):
+    """Expand directories to the config files they contain, None for the default config file"""
+    if not config_files:
+        return [None]
+
+    expanded = []
+    for config_file in config_files:
+        if os.path.isdir(config_file):
+            expanded.extend(sorted(glob.glob(os.path.join(config_file, '*.json'))))
+        else:
+            expanded.append(config_file)
+    return expanded
+
+
+def get_runs(config_files, token):
+    """
+    :param config_files: Config files
+    :param token: PAT from argument
+    :return: List of (config file, project name, output directory) to run. Configs with "*" as project_name
+             run for every project of the org. A single run writes to out/, several to out/<project name>/.
+    """
+    runs = []
+    for config_file in config_files:
+        conf = Config(filename=config_file if config_file is not None else __CONFIG_FILE__).config
+        if conf.get('project_name') == '*':
+            connection = get_connection(conf['url'], token.strip() or conf['pat'])
+            for project_name in get_project_names(connection):
+                runs.append((config_file, project_name))
+        else:
+            runs.append((config_file, None))
+
+    out_dir = os.path.dirname(__OUT_FILE__)
+    if len(runs) == 1:
+        return [(runs[0][0], runs[0][1], out_dir)]
+
+    config_runs = []
+    output_dirs = set()
+    for config_file, project_name in runs:
+        config_name = os.path.splitext(os.path.basename(config_file))[0]
+        output_dir = os.path.join(out_dir, get_safe_file_name(
+            project_name or Config(filename=config_file).config.get('project_name') or config_name))
+        # Same project in several configs
+        if output_dir in output_dirs:
+            output_dir += '_' + get_safe_file_name(config_name)
+        output_dirs.add(output_dir)
+        config_runs.append((config_file, project_name, output_dir))
+    return config_runs
+
+
+def main(token, config_file=None, output_path=None, output_format=None, incremental=None, resume=False,
+         project_name=None, output_dir=None, metrics=None):
 
     # Program Started
     start = time.time()
@@ -124,7 +252,22 @@ def main(token, config_file=None, output_path=None):
     print("Initiated at ", datetime.datetime.now())
 
     # Pass PAT argument
-    context = init(token, config_file)
+    context = init(token, config_file, project_name=project_name, output_dir=output_dir)
+    if output_format:
+        context.output_format = output_format
+    if incremental is not None:
+        context.incremental = incremental
+    if metrics is not None:
+        context.http_metrics = metrics
+    if output_path:
+        context.http_capture_file = output_path
+    if not os.path.exists(context.output_dir):
+        os.makedirs(context.output_dir)
+    dump_file = get_output_file_name(os.path.join(context.output_dir, os.path.basename(__DUMP_FILE__)),
+                                     context.output_format)
+    out_file = get_output_file_name(os.path.join(context.output_dir, os.path.basename(__OUT_FILE__)),
+                                    context.output_format)
+    journal_file = os.path.join(context.output_dir, os.path.basename(__JOURNAL_FILE__))
     test_run = context.test_run
     test_work_item_id = context.test_work_item_id
 
@@ -133,13 +276,22 @@ def main(token, config_file=None, output_path=None):
     else:
         top_count = None
 
-    if output_path:
-        # monkey-patch the get_client method to attach our hook
-        _get_client = context.connection.get_client
+    # Request metrics are collected by the hook attached to every client of the connection
+    if context.http_metrics:
+        http_logging.enable_metrics()
+
+    # Sampled request/response cycles, written by a background thread
+    if context.http_capture_file:
+        http_logging.start_capture(context.http_capture_file,
+                                   sample_rate=context.http_capture_sample_rate,
+                                   max_body_bytes=context.http_capture_max_body_bytes,
+                                   max_file_bytes=context.http_capture_max_file_bytes,
+                                   max_files=context.http_capture_max_files)
 
     # Log Config
     logger.info("--------CONFIG--------------")
     logger.info("Project     : %s", context.project_name)
+    logger.info("Output dir  : %s", context.output_dir)
     logger.info("Start Date  : %s", context.project_start_date)
     logger.info("Start Date  : %s", context.project_end_date)
     logger.info("url         : %s", context.url)
@@ -147,6 +299,12 @@ def main(token, config_file=None, output_path=None):
     logger.info("Test Work Item    : %s", test_work_item_id)
     logger.info("Set future actual percent None: %s", context.future_actuals_are_None)
     logger.info("Field list array : %s", context.fields_array)
+    logger.info("Actuals mode : %s", context.actuals_mode)
+    logger.info("Max concurrency : %s", context.max_concurrency)
+    logger.info("Output format : %s", context.output_format)
+    logger.info("Incremental : %s", context.incremental)
+    logger.info("HTTP metrics : %s", context.http_metrics)
+    logger.info("HTTP capture : %s", context.http_capture_file)
 
     # List fields to Extract Initially
     fields_array = context.fields_array
@@ -166,6 +324,11 @@ def main(token, config_file=None, output_path=None):
     df_all_weeks = pd.DataFrame({'week_starting': list_range})
     current_week = datetime.datetime.strptime(str(today), '%Y-%m-%d')
 
+    # Projects discovered from the org only extract their own Work Items
+    project_filter = None
+    if project_name is not None:
+        project_filter = "[System.TeamProject] = '" + project_name.replace("'", "''") + "'"
+
     # Get all Program Deliverable Work items Only
     if test_run:
         print("Test Run with Work item ", test_work_item_id)
@@ -173,18 +336,37 @@ def main(token, config_file=None, output_path=None):
                                                          work_item_id=test_work_item_id)
     else:
         df_work_items = get_program_work_items_data_frame(context, fields_array=fields_array, as_of_date=current_week,
-                                                          top_n=top_count)
+                                                          top_n=top_count, filter_string=project_filter)
+
+    # Incremental run - the weeks up to the last complete week of the existing output are kept as they are
+    df_existing = None
+    last_complete_week = None
+    if context.incremental and not test_run:
+        df_existing = read_df(out_file, context.output_format)
+        if df_existing is not None:
+            last_complete_week = get_last_complete_report_date(df_existing, df_work_items['System.Id'],
+                                                               df_all_weeks['week_starting'], current_week)
+        logger.info("Last complete week of existing output : %s", last_complete_week)
 
     work_item_count = len(df_work_items)
     total_weeks = len(df_all_weeks)
+    if last_complete_week is not None:
+        total_weeks -= sum(week.date() <= last_complete_week for week in df_all_weeks['week_starting'])
     total_iteration = work_item_count * total_weeks
     pbar = tqdm(total=total_iteration)
 
     current_iteration = 0
 
     # Write the extract dump to csv file
-    write_df_to_csv(df_work_items, __DUMP_FILE__)
-    logger.info("Extract Dump Created at %s", __DUMP_FILE__)
+    write_df(df_work_items, dump_file, output_format=context.output_format)
+    logger.info("Extract Dump Created at %s", dump_file)
+
+    # Journal of the completed weeks, to resume the run if interrupted
+    journal = RunJournal(journal_file, get_run_hash(context.config, current_week, df_work_items['System.Id']),
+                         resume=resume)
+
+    # GREEN and RED forecast percentages for all Work Items and weeks
+    green_pcts, red_pcts = calc_forecast_matrices(df_work_items, df_all_weeks['week_starting'])
 
     df_intr = []
     # For each week from Start to End of Project
@@ -192,6 +374,10 @@ def main(token, config_file=None, output_path=None):
         # Column name as Week Name
         loop_week_starting = datetime.datetime.strptime(str(row['week_starting']), '%Y-%m-%d %H:%M:%S')
 
+        # Already in the existing output
+        if last_complete_week is not None and loop_week_starting.date() <= last_complete_week:
+            continue
+
         # Calculate Percentage for Each Week
         """
         # For each Work Item with Program Deliverable Tag
@@ -245,8 +431,13 @@ def main(token, config_file=None, output_path=None):
         if test_run and index > 5:
             break
         """
-        res = get_work_item_percent_as_of(context, df_work_items=df_work_items, current_week=current_week,
-                                          as_of_week=loop_week_starting, test_run=test_run)
+        if loop_week_starting.date() in journal.completed_weeks:
+            res = journal.completed_weeks[loop_week_starting.date()]
+        else:
+            res = get_work_item_percent_as_of(context, df_work_items=df_work_items, current_week=current_week,
+                                              as_of_week=loop_week_starting, test_run=test_run,
+                                              green_pcts=green_pcts[:, index], red_pcts=red_pcts[:, index])
+            journal.add_week(loop_week_starting.date(), res)
         for item in res:
             df_intr.insert(0, item)
 
@@ -255,21 +446,54 @@ def main(token, config_file=None, output_path=None):
         pbar.update(n=work_item_count)
 
     # Convert the result (Historical Progress Percentages) to Dataframe
-    df_tmp = pd.DataFrame(df_intr)
-
     # Match the number of fields as per df_intr dataframe columns
-    df_tmp.columns = ['id', 'report_date', 'green_forecast_percent', 'red__forecast_percent', 'actual_percent']
+    df_tmp = pd.DataFrame(df_intr, columns=TRACKING_COLUMNS)
+
+    # Merge with the complete weeks of the existing output, for the Work Items still in the extract
+    if last_complete_week is not None:
+        df_existing['report_date'] = pd.to_datetime(df_existing['report_date'].astype(str)).dt.date
+        df_existing = df_existing[(df_existing['report_date'] <= last_complete_week)
+                                  & df_existing['id'].isin(df_work_items['System.Id'])]
+        df_tmp = pd.concat([df_tmp, df_existing[TRACKING_COLUMNS]], ignore_index=True)
 
     df_tmp.sort_values(['id', 'report_date'])
 
-    # Write Data frame result to CSV
-    write_df_to_csv(df_tmp, output_file_name=__OUT_FILE__)
+    # Write Data frame result to the output file, partitioned by week unless CSV
+    write_df(df_tmp, out_file, output_format=context.output_format, partition_cols=['report_date'],
+             dtypes=TRACKING_DTYPES)
+
+    # Output is complete, the journal is no longer needed
+    journal.remove()
 
     if test_run:
         print(df_tmp)
 
     pbar.close()
 
+    # Response cache statistics
+    response_cache = getattr(context.runner_cache, 'response_cache', None)
+    if response_cache is not None:
+        logger.info("Response cache : %s", response_cache.stats())
+        response_cache.close()
+
+    # HTTP request metrics, of all the runs of the process so far when several projects are run
+    if context.http_metrics:
+        metrics_file = os.path.join(context.output_dir, os.path.basename(__METRICS_FILE__))
+        http_logging.metrics.write_json(metrics_file)
+        http_logging.metrics.write_prometheus(os.path.join(context.output_dir,
+                                                           os.path.basename(__METRICS_PROM_FILE__)))
+        for endpoint, endpoint_metrics in http_logging.metrics.to_dict()['endpoints'].items():
+            logger.info("HTTP %s : %s requests, p50 %ss, p95 %ss, p99 %ss, %s retries", endpoint,
+                        endpoint_metrics['requests'], endpoint_metrics['latency_p50'],
+                        endpoint_metrics['latency_p95'], endpoint_metrics['latency_p99'],
+                        endpoint_metrics['retries'])
+        logger.info("HTTP metrics written to %s", metrics_file)
+
+    if context.http_capture_file:
+        capture_stats = http_logging.stop_capture()
+        if capture_stats is not None:
+            logger.info("HTTP capture : %s", capture_stats)
+
     # Execution Complete
     end = time.time()
     hours, rem = divmod(end - start, 3600)
@@ -8,6 +8,10 @@ import re
 import ast
 #from dateutil import rrule
 import csv
+import os
+import shutil
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from pandas import DataFrame
 import pandas as pd
 from exceptions import AccountStateError
@@ -82,6 +86,33 @@ def find_any_build_definition(context):
         raise AccountStateError('Project "%s" doesn''t appear to have any build definitions.' % (project.name,))
 
 
+def get_project_names(connection):
+    """Names of all the projects of the org, following the continuation token across pages"""
+    logger.debug('getting all projects')
+
+    core_client = connection.clients.get_core_client()
+    project_names = []
+
+    get_projects_response = core_client.get_projects()
+    while get_projects_response is not None:
+        project_names.extend(project.name for project in get_projects_response.value)
+        if get_projects_response.continuation_token is not None and get_projects_response.continuation_token != "":
+            # Get the next page of projects
+            get_projects_response = core_client.get_projects(
+                continuation_token=get_projects_response.continuation_token)
+        else:
+            # All projects have been retrieved
+            get_projects_response = None
+
+    logger.debug('found %s projects', len(project_names))
+    return project_names
+
+
+def get_safe_file_name(name):
+    """Name usable as a file or directory name"""
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') or '_'
+
+
 def write_json(json_txt, output_file):
     logger.debug("Writing json file %s", output_file)
     with open(output_file, "w+") as write_file:
@@ -134,39 +165,74 @@ def json_sanitize(value: Union[str, dict, list], is_value=True) -> Union[str, di
     return value
 
 
+# Declared dtypes of the extract columns, applied to the columns present in the extract
+WORK_ITEM_SCHEMA = {
+    'System.Id': 'int32',
+    'System.CreatedDate': 'datetime64[ns, UTC]',
+    'System.ChangedDate': 'datetime64[ns, UTC]',
+    'Custom.GreenStartDate': 'datetime64[ns, UTC]',
+    'Custom.GreenEndDate': 'datetime64[ns, UTC]',
+    'Custom.RedStartDate': 'datetime64[ns, UTC]',
+    'Custom.RedEndDate': 'datetime64[ns, UTC]',
+    'System.State': 'category',
+    'System.AreaPath': 'category',
+    'System.IterationPath': 'category',
+    'System.Tags': 'category',
+    'System.WorkItemType': 'category',
+}
+
+# Format of the date fields, as returned by Azure DevOps
+DEVOPS_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def to_utc_datetimes(values):
+    """Parse Azure DevOps date values, which mix second and sub-second precision, to UTC datetimes"""
+    try:
+        return pd.to_datetime(values, utc=True, format='ISO8601')
+    except ValueError:
+        # pandas < 2.0 has no ISO8601 format, but already parses mixed precision ISO 8601 dates by default
+        return pd.to_datetime(values, utc=True)
+
+
+def apply_work_item_schema(data_frame):
+    for column, dtype in WORK_ITEM_SCHEMA.items():
+        if column not in data_frame:
+            continue
+        if dtype.startswith('datetime64'):
+            data_frame[column] = to_utc_datetimes(data_frame[column]).astype(dtype)
+        elif dtype.startswith('int') and data_frame[column].isnull().any():
+            # Nullable integer when some Work Items don't have the field
+            data_frame[column] = data_frame[column].astype(dtype.capitalize())
+        else:
+            data_frame[column] = data_frame[column].astype(dtype)
+    return data_frame
+
+
 def convert_work_item_to_dataframe(work_items):
     logger.debug("Converting Workitems List to Dataframe")
 
-    workitems_df_list: List[DataFrame] = []
+    # Gather the fields into one list per column, in a single pass over the Work Items
+    columns = {}
     rec_count = 0
     for work_item in work_items:
-        field_names = []
-        for field in work_item.fields:
-            field_names.append(field)
-
-        wi = pd.DataFrame(work_item.fields, index=[rec_count])
-        workitems_df_list.append(wi)
+        for field, value in work_item.fields.items():
+            if field not in columns:
+                # Field not seen before, earlier Work Items don't have it
+                columns[field] = [np.nan] * rec_count
+            columns[field].append(value)
         rec_count += 1
 
-        """row = "{0},{1},{2},{3},{4},{5},{6}".format(
-            work_item.id,
-            work_item.fields["System.TeamProject"],
-            work_item.fields["System.WorkItemType"],
-            work_item.fields["System.Title"],
-            work_item.fields["System.State"],
-            work_item.fields["Microsoft.VSTS.Common.Priority"],
-            work_item.fields["System.CreatedDate"]
-        )
-        workitems_df_list.append(pd.DataFrame(list(reader([row]))))
-    """
+        # Work Items without some of the fields
+        for column in columns.values():
+            if len(column) < rec_count:
+                column.append(np.nan)
 
-    try:
-        workitems_final_df = pd.concat(workitems_df_list)
-    except ValueError as e:
-        logger.log("No data to convert to Dataframe - Error: ", e)
+    if rec_count == 0:
+        logger.warning("No data to convert to Dataframe")
         print("No data to convert to Dataframe. Review Program Only Wiql query")
+        return DataFrame()
 
-    return workitems_final_df
+    return apply_work_item_schema(DataFrame(columns))
 
 
 def parse_json(json_file_name):
@@ -191,6 +257,48 @@ def parse_json(json_file_name):
     return list_of_json
 
 
+def chunks(items, size):
+    """Split an iterable into lists of at most size elements, preserving order"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bounded_map(func, items, max_concurrency=1):
+    """
+    Lazily apply func to every item on a thread pool, with at most max_concurrency calls in flight.
+    Results are yielded in the order of the items, whatever order the calls complete in.
+    """
+    if max_concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_devops_date(value):
+    """Parse an Azure DevOps UTC date string (e.g. 2021-03-22T04:05:06.78Z) to a naive UTC datetime"""
+    value = str(value).rstrip('Z')
+    value, _, fraction = value.partition('.')
+    date = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        date = date.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return date
+
+
 def weeks_between(start_date, end_date):
     x = pd.to_datetime(end_date) - pd.to_datetime(start_date)
     return int(x / np.timedelta64(1, 'W'))
@@ -201,11 +309,18 @@ def days_between(start_date, end_date):
     return int(x / np.timedelta64(1, 'D'))
 
 
+def _to_utc_date(value):
+    # Dates are either Azure DevOps date strings or UTC datetimes when typed by WORK_ITEM_SCHEMA
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return datetime.datetime.strptime(str(value), DEVOPS_DATE_FORMAT).date()
+
+
 def calc_pct_completion(item_start_date, item_end_date, curr_week_starting):
-    if str(item_start_date) != 'nan' and str(item_end_date) != 'nan':
+    if not pd.isnull(item_start_date) and not pd.isnull(item_end_date):
         try:
-            start_date = datetime.datetime.strptime(str(item_start_date), '%Y-%m-%dT%H:%M:%SZ').date()
-            end_date = datetime.datetime.strptime(str(item_end_date), '%Y-%m-%dT%H:%M:%SZ').date()
+            start_date = _to_utc_date(item_start_date)
+            end_date = _to_utc_date(item_end_date)
             curr_week_starting = datetime.datetime.strptime(str(curr_week_starting), '%Y-%m-%d %H:%M:%S').date()
             tot_weeks_wi = weeks_between(start_date, end_date)
             weeks_passed = weeks_between(start_date, curr_week_starting)
@@ -237,10 +352,193 @@ def calc_pct_completion(item_start_date, item_end_date, curr_week_starting):
     return pct
 
 
+def parse_dates_to_days(values):
+    """
+    :param values: Azure DevOps date values (strings or datetimes), NaN / None when not set
+    :return: datetime64[D] array of the UTC dates, NaT when not set
+    """
+    dates = to_utc_datetimes(pd.Series(values, dtype=object))
+    return dates.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+
+
+def _weeks_truncated(days):
+    # Same as weeks_between: whole weeks, truncated towards zero
+    return np.where(days >= 0, days // 7, -(-days // 7))
+
+
+def calc_pct_completion_matrix(item_start_dates, item_end_dates, weeks_starting):
+    """
+    Vectorized calc_pct_completion for all Work Items and weeks at once.
+    :param item_start_dates: Start date of each Work Item
+    :param item_end_dates: End date of each Work Item
+    :param weeks_starting: Week starting dates
+    :return: (items x weeks) float array of the completion percentages, identical to calc_pct_completion
+    """
+    start_dates = parse_dates_to_days(item_start_dates)[:, np.newaxis]
+    end_dates = parse_dates_to_days(item_end_dates)[:, np.newaxis]
+    weeks_starting = np.asarray(pd.to_datetime(list(weeks_starting)).values, dtype='datetime64[D]')[np.newaxis, :]
+
+    is_set = ~(np.isnat(start_dates) | np.isnat(end_dates))
+
+    # Work on whole days, unset dates are replaced so that the arithmetic stays valid
+    tot_days_wi = np.where(is_set, end_dates - start_dates, np.timedelta64(0, 'D')).astype(np.int64)
+    days_passed = np.where(is_set, weeks_starting - start_dates, np.timedelta64(0, 'D')).astype(np.int64)
+    tot_weeks_wi = _weeks_truncated(tot_days_wi)
+    weeks_passed = _weeks_truncated(days_passed)
+
+    # Less than a week between start and end (ZeroDivisionError in calc_pct_completion) is reported as 0
+    has_weeks = tot_weeks_wi != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = (weeks_passed / np.where(has_weeks, tot_weeks_wi, 1)) * 100
+
+    pct = np.where(weeks_passed < 0, 0.0, pct)
+    pct = np.where(has_weeks, pct, 0.0)
+    pct = np.where(pct >= 100, 100.0, pct)
+
+    return np.where(is_set, pct, 0.0)
+
+
+def calc_forecast_matrices(df_work_items, weeks_starting):
+    """
+    :param df_work_items: Work Items with the Custom.Green*/Red* Start and End dates
+    :param weeks_starting: Week starting dates
+    :return: Tuple of (items x weeks) GREEN and RED forecast percentage arrays
+    """
+    def dates(column):
+        if column in df_work_items:
+            return df_work_items[column]
+        return [np.nan] * len(df_work_items)
+
+    green_pcts = calc_pct_completion_matrix(dates('Custom.GreenStartDate'), dates('Custom.GreenEndDate'),
+                                            weeks_starting)
+    red_pcts = calc_pct_completion_matrix(dates('Custom.RedStartDate'), dates('Custom.RedEndDate'), weeks_starting)
+    return green_pcts, red_pcts
+
+
 def write_df_to_csv(data_frame, output_file_name):
     logger.debug("Writing out csv file %s", output_file_name)
     data_frame.to_csv(output_file_name, sep=',', index=False, mode='w', quoting=csv.QUOTE_ALL, quotechar='"',
-                      escapechar="\\")
+                      escapechar="\\", date_format=DEVOPS_DATE_FORMAT)
+
+
+
+
+
+# Supported output file formats
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather']
+
+# Columns of the WorkItemTracking output
+TRACKING_COLUMNS = ['id', 'report_date', 'green_forecast_percent', 'red__forecast_percent', 'actual_percent']
+
+# Stable column types of the WorkItemTracking output
+TRACKING_DTYPES = {
+    'id': 'int64',
+    'green_forecast_percent': 'int64',
+    'red__forecast_percent': 'int64',
+    'actual_percent': 'float64',
+}
+
 
+def get_output_file_name(output_file_name, output_format):
+    """Output file name with the extension of the output format, e.g. out/WorkItemTracking.parquet"""
+    return os.path.splitext(output_file_name)[0] + '.' + output_format
 
 
+def write_df(data_frame, output_file_name, output_format='csv', partition_cols=None, dtypes=None):
+    """
+    :param data_frame: Dataframe to write
+    :param output_file_name: File to write, a directory for partitioned parquet
+    :param output_format: One of OUTPUT_FORMATS
+    :param partition_cols: Columns to partition parquet output by, ignored for other formats
+    :param dtypes: Column types to cast to before writing binary formats, for a stable schema
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("{0} is not a valid output format, expected one of {1}".format(output_format, OUTPUT_FORMATS))
+
+    # Write next to the output first, so readers never see a partially written output
+    tmp_file_name = output_file_name + '.tmp'
+
+    if output_format == 'csv':
+        write_df_to_csv(data_frame, tmp_file_name)
+    else:
+        if dtypes:
+            data_frame = data_frame.astype({column: dtype for column, dtype in dtypes.items() if column in data_frame})
+
+        if output_format == 'parquet':
+            write_df_to_parquet(data_frame, tmp_file_name, partition_cols=partition_cols)
+        else:
+            write_df_to_feather(data_frame, tmp_file_name)
+
+    replace_output(tmp_file_name, output_file_name)
+
+
+def replace_output(new_file_name, output_file_name):
+    """Replace the output file (or partitioned output directory) with the newly written one"""
+    if os.path.isdir(new_file_name):
+        old_file_name = output_file_name + '.old'
+        if os.path.isdir(old_file_name):
+            shutil.rmtree(old_file_name)
+        if os.path.exists(output_file_name):
+            os.rename(output_file_name, old_file_name)
+        os.rename(new_file_name, output_file_name)
+        if os.path.isdir(old_file_name):
+            shutil.rmtree(old_file_name)
+    else:
+        os.replace(new_file_name, output_file_name)
+
+
+def read_df(output_file_name, output_format='csv'):
+    """
+    :param output_file_name: File written by write_df
+    :param output_format: One of OUTPUT_FORMATS
+    :return: Dataframe, None when the file does not exist
+    """
+    if not os.path.exists(output_file_name):
+        return None
+
+    logger.debug("Reading %s file %s", output_format, output_file_name)
+    if output_format == 'csv':
+        return pd.read_csv(output_file_name, sep=',', quotechar='"', escapechar="\\")
+    if output_format == 'parquet':
+        return pd.read_parquet(output_file_name, engine='pyarrow')
+    return pd.read_feather(output_file_name)
+
+
+def get_last_complete_report_date(df_tracking, ids, weeks_starting, current_week):
+    """
+    :param df_tracking: Existing WorkItemTracking output
+    :param ids: Work Item IDs of the current extract
+    :param weeks_starting: Week starting dates from project start
+    :param current_week: Today
+    :return: Last week of the unbroken run of past weeks from project start that has a row for every
+             Work Item, None if there is none. The current week and later are never complete.
+    """
+    report_dates = pd.to_datetime(df_tracking['report_date'].astype(str)).dt.date
+    ids_by_report_date = df_tracking['id'].astype(int).groupby(report_dates).apply(set)
+    ids = set(int(id_) for id_ in ids)
+
+    last_complete_report_date = None
+    for week_starting in weeks_starting:
+        week_starting = pd.Timestamp(week_starting).date()
+        # Actuals of the current week are as of today, so they can still change
+        if weeks_between(week_starting, current_week.date()) <= 0:
+            break
+        if not ids <= ids_by_report_date.get(week_starting, set()):
+            break
+        last_complete_report_date = week_starting
+
+    return last_complete_report_date
+
+
+def write_df_to_parquet(data_frame, output_file_name, partition_cols=None):
+    logger.debug("Writing out parquet file %s", output_file_name)
+    # Partitioned output is a directory, remove the previous one so it is overwritten like a file
+    if os.path.isdir(output_file_name):
+        shutil.rmtree(output_file_name)
+    data_frame.to_parquet(output_file_name, engine='pyarrow', compression='snappy', index=False,
+                          partition_cols=partition_cols)
+
+
+def write_df_to_feather(data_frame, output_file_name):
+    logger.debug("Writing out feather file %s", output_file_name)
+    data_frame.reset_index(drop=True).to_feather(output_file_name, compression='zstd')
@@ -1,13 +1,32 @@
 """Implementation of Azure DevOps WorkItems
 """
+import bisect
 import math
 import numpy
-from azure.devops.v6_0.work_item_tracking.models import Wiql
+from azure.devops.v6_0.work_item_tracking.models import Wiql, WorkItem, WorkItemBatchGetRequest
+from response_cache import ResponseCache, DEFAULT_RESPONSE_CACHE_MAX_ENTRIES
+from revision_store import RevisionStore, DEFAULT_REVISION_STORE_FILE
 from utils import *
 
 
 logger = logging.getLogger(__name__)
 
+# Largest number of IDs the WIT API accepts in a single get_work_items / workitemsbatch call
+MAX_BATCH_SIZE = 200
+
+# Fields required to calculate the Actual (White) completion percentage
+ACTUALS_FIELDS = ["System.Id", "Custom.ProgressPercentageComplete"]
+
+# How the Actual (White) completion percentage is looked up for each week
+#   item    - one as of request per Work Item per week
+#   batch   - one as of request per MAX_BATCH_SIZE Work Items per week
+#   history - one (paged) revision history request per Work Item, replayed locally for every week
+#   store   - revisions synced incrementally from the reporting revisions API into a local RevisionStore
+ACTUALS_MODES = ["item", "batch", "history", "store"]
+
+# Fields synced from the reporting revisions API into the RevisionStore
+REVISION_STORE_FIELDS = ["System.Id", "System.Rev", "System.ChangedDate", "Custom.ProgressPercentageComplete"]
+
 
 def print_work_item(work_item):
     emit(
@@ -51,6 +70,31 @@ def get_work_items_as_of(context, as_of_date=None):
     return work_items
 
 
+def get_max_concurrency(context):
+    """Number of concurrent requests to the Azure DevOps server, from the max_concurrency config key"""
+    return getattr(context, 'max_concurrency', None) or 1
+
+
+def get_work_items_by_id(wit_client, ids, fields_array=None, as_of_date=None, max_concurrency=1):
+    """
+    Lazily yield the Work Items for the given IDs, hydrated MAX_BATCH_SIZE IDs per workitemsbatch request.
+    :param wit_client: WI Tracking Client
+    :param ids: Work Item IDs, as returned by a WIQL query
+    :param fields_array: Fields to fetch
+    :param as_of_date: As of date for all the Work Items
+    :param max_concurrency: Number of batch requests in flight at a time
+    :return: Generator of Work Items, in the order of the IDs. IDs omitted by the server are skipped.
+    """
+    def get_chunk(chunk):
+        request = WorkItemBatchGetRequest(ids=chunk, fields=fields_array, as_of=as_of_date, error_policy="omit")
+        return wit_client.get_work_items_batch(request)
+
+    for work_items in bounded_map(get_chunk, chunks(ids, MAX_BATCH_SIZE), max_concurrency=max_concurrency):
+        for work_item in work_items:
+            if work_item is not None:
+                yield work_item
+
+
 def wiql_query(context, top_n=None, program_only=None, fields_array=None, as_of_date=None):
 
     if as_of_date is not None:
@@ -100,9 +144,9 @@ def wiql_query(context, top_n=None, program_only=None, fields_array=None, as_of_
     if wiql_results:
         # WIQL query gives a WorkItemReference with ID only
         # => we get the corresponding WorkItem from id
-        work_items = (
-            wit_client.get_work_item(int(res.id), fields=fields_array, as_of=as_of_date) for res in wiql_results
-        )
+        work_items = get_work_items_by_id(wit_client, [int(res.id) for res in wiql_results],
+                                          fields_array=fields_array, as_of_date=as_of_date,
+                                          max_concurrency=get_max_concurrency(context))
 
         return work_items
     else:
@@ -169,9 +213,9 @@ def wiql_query_with_filter(context, top_n=None, program_only=None, fields_array=
         if wiql_results:
             # WIQL query gives a WorkItemReference with ID only
             # => we get the corresponding WorkItem from id
-            work_items = (
-                wit_client.get_work_item(int(res.id), fields=fields_array, as_of=as_of_date) for res in wiql_results
-            )
+            work_items = get_work_items_by_id(wit_client, [int(res.id) for res in wiql_results],
+                                              fields_array=fields_array, as_of_date=as_of_date,
+                                              max_concurrency=get_max_concurrency(context))
     except:
         print("ERROR: Auth Failed. Verify PAT in Configuration")
         logger.error("ERROR: Auth Failed. Verify PAT in Configuration")
@@ -183,15 +227,17 @@ def wiql_query_with_filter(context, top_n=None, program_only=None, fields_array=
 
 
 # Using WIQL
-def get_program_work_items_data_frame(context, top_n=None, fields_array=None, as_of_date=None):
+def get_program_work_items_data_frame(context, top_n=None, fields_array=None, as_of_date=None, filter_string=None):
 
     if as_of_date is not None:
         as_of_date = datetime.datetime.strptime(str(as_of_date), '%Y-%m-%d %H:%M:%S')
 
     if top_n is None:
-        work_items = wiql_query_with_filter(context, program_only=True, fields_array=fields_array, as_of_date=as_of_date)
+        work_items = wiql_query_with_filter(context, program_only=True, fields_array=fields_array, as_of_date=as_of_date,
+                                            filter_string=filter_string)
     else:
-        work_items = wiql_query_with_filter(context, top_n, program_only=True, fields_array=fields_array, as_of_date=as_of_date)
+        work_items = wiql_query_with_filter(context, top_n, program_only=True, fields_array=fields_array,
+                                            as_of_date=as_of_date, filter_string=filter_string)
 
     df = convert_work_item_to_dataframe(work_items)
     #write_df_to_csv(data_frame=df, output_file_name=extract_file)
@@ -232,13 +278,292 @@ def get_work_items_as_of(context, desired_id_range, as_of_date=None, fields=None
     return work_items
 
 
-def get_work_item_percent_as_of(context, df_work_items, current_week, as_of_week, test_run):
+# Uses WI Tracking Client - one request per MAX_BATCH_SIZE IDs
+def get_work_items_as_of_batch(context, ids, as_of_date=None, fields=None):
+    """
+    :param context: Pass the current Context
+    :param ids: Work Item IDs to fetch
+    :param as_of_date: As of date for all the Work Items
+    :param fields: Fields to fetch
+    :return: Dict of Work Item ID to Work Item, None for IDs omitted by the server
+    """
+    if fields is None:
+        fields = ACTUALS_FIELDS
+
+    if as_of_date is not None:
+        as_of_date = datetime.datetime.strptime(str(as_of_date), '%Y-%m-%d %H:%M:%S')
+    else:
+        as_of_date = datetime.datetime.now()
+
+    # Remove duplicates but keep the requested order
+    ids = list(dict.fromkeys(int(id_) for id_ in ids))
+
+    wit_client = context.connection.clients.get_work_item_tracking_client()
+
+    def get_chunk(chunk):
+        logger.debug("Fetching %s Work Items as of %s", len(chunk), as_of_date)
+        return wit_client.get_work_items(ids=chunk, error_policy="omit", as_of=as_of_date, fields=fields)
+
+    work_items = dict.fromkeys(ids)
+
+    # Past dated lookups never change, only request the ones not in the response cache
+    response_cache = get_response_cache(context)
+    if response_cache is not None:
+        cached = response_cache.get_many(ids, as_of_date, fields)
+        for id_, cached_fields in cached.items():
+            work_items[id_] = WorkItem(id=id_, fields=cached_fields) if cached_fields is not None else None
+        ids = [id_ for id_ in ids if id_ not in cached]
+
+    for results in bounded_map(get_chunk, chunks(ids, MAX_BATCH_SIZE), max_concurrency=get_max_concurrency(context)):
+        # Omitted IDs are returned as None, so match the results on the ID rather than the position
+        for work_item in results:
+            if work_item is not None:
+                work_items[work_item.id] = work_item
+
+    if response_cache is not None:
+        response_cache.put_many({id_: work_items[id_].fields if work_items[id_] is not None else None for id_ in ids},
+                                as_of_date, fields)
+
+    return work_items
+
+
+def get_response_cache(context):
+    """
+    :param context: Pass the current Context
+    :return: ResponseCache of the run, None when context.response_cache_file is not set
+    """
+    if not hasattr(context.runner_cache, 'response_cache'):
+        response_cache_file = getattr(context, 'response_cache_file', None)
+        if response_cache_file:
+            max_entries = getattr(context, 'response_cache_max_entries', None) or DEFAULT_RESPONSE_CACHE_MAX_ENTRIES
+            context.runner_cache.response_cache = ResponseCache(response_cache_file, max_entries=max_entries)
+        else:
+            context.runner_cache.response_cache = None
+
+    return context.runner_cache.response_cache
+
+
+def get_work_item_actual_percent_as_of(context, work_item_id, as_of_date):
+    """
+    :param context: Pass the current Context
+    :param work_item_id: Work Item ID
+    :param as_of_date: As of date
+    :return: Actual (White) completion percentage of the Work Item, using one request for the Work Item
+    """
+    id_range = str(work_item_id) + ',' + str(work_item_id + 1)
+    for work_item in get_work_items_as_of(context, as_of_date=as_of_date, desired_id_range=id_range,
+                                          fields=ACTUALS_FIELDS):
+        return get_work_item_actual_percent(work_item)
+    return 0
+
+
+def get_work_item_actual_percent(work_item):
+    """
+    :param work_item: Work Item as returned by the WI Tracking Client, None when omitted
+    :return: Actual (White) completion percentage of the Work Item
+    """
+    # When the Work Item did not exist as of the given date, the value should be set to 0
+    if work_item is None:
+        return 0
+    return get_actual_percent(work_item.fields)
+
+
+def get_actual_percent(fields):
+    """
+    :param fields: Fields of a Work Item or Work Item revision
+    :return: Actual (White) completion percentage
+    """
+    # When the field was not updated as of the given date, the value should be set to 0
+    try:
+        return int(fields["Custom.ProgressPercentageComplete"])
+    except KeyError:
+        return 0
+
+
+def get_work_item_revisions(context, work_item_id, page_size=MAX_BATCH_SIZE):
+    """
+    :param context: Pass the current Context
+    :param work_item_id: Work Item to get the revision history of
+    :param page_size: Number of revisions to get per request
+    :return: List of all revisions of the Work Item
+    """
+    wit_client = context.connection.clients.get_work_item_tracking_client()
+
+    revisions = []
+    while True:
+        page = wit_client.get_revisions(int(work_item_id), top=page_size, skip=len(revisions))
+        revisions.extend(page)
+        if len(page) < page_size:
+            break
+
+    logger.debug("Fetched %s revisions for Work Item %s", len(revisions), work_item_id)
+    return revisions
+
+
+def build_change_log(revisions):
+    """
+    :param revisions: Revisions of a Work Item
+    :return: Tuple of sorted change dates and the Actual (White) percentage from each date onwards
+    """
+    return compact_change_log((parse_devops_date(revision.fields["System.ChangedDate"]), revision.rev,
+                               get_work_item_actual_percent(revision)) for revision in revisions)
+
+
+def compact_change_log(changes):
+    """
+    :param changes: (changed_date, rev, actual_percent) tuples of a Work Item, in any order
+    :return: Tuple of sorted change dates and the Actual (White) percentage from each date onwards
+    """
+    change_dates = []
+    values = []
+    for change_date, rev, value in sorted(changes):
+        # Only keep the revisions where the percentage changed
+        if values and values[-1] == value:
+            continue
+        change_dates.append(change_date)
+        values.append(value)
+
+    return change_dates, values
+
+
+def get_actual_percent_from_change_log(change_log, as_of_date):
+    """
+    :param change_log: Tuple of sorted change dates and values as built by build_change_log
+    :param as_of_date: As of date
+    :return: Actual (White) percentage as of the given date, 0 when the Work Item did not exist yet
+    """
+    change_dates, values = change_log
+    position = bisect.bisect_right(change_dates, as_of_date)
+    if position == 0:
+        return 0
+    return values[position - 1]
+
+
+def get_work_item_change_logs(context, ids):
+    """
+    :param context: Pass the current Context
+    :param ids: Work Item IDs
+    :return: Dict of Work Item ID to change log. Change logs are cached for the run, so the
+             revision history of each Work Item is only requested once.
+    """
+    if not hasattr(context.runner_cache, 'change_logs'):
+        context.runner_cache.change_logs = {}
+    change_logs = context.runner_cache.change_logs
+
+    missing_ids = [int(id_) for id_ in ids if int(id_) not in change_logs]
+    revisions = bounded_map(lambda id_: get_work_item_revisions(context, id_), missing_ids,
+                            max_concurrency=get_max_concurrency(context))
+    for id_, id_revisions in zip(missing_ids, revisions):
+        change_logs[id_] = build_change_log(id_revisions)
+
+    return change_logs
+
+
+def sync_revision_store(context, store):
+    """
+    Pull all revisions newer than the store watermark from the reporting revisions API.
+    :param context: Pass the current Context
+    :param store: RevisionStore to add the revisions to
+    :return: Number of revisions added
+    """
+    wit_client = context.connection.clients.get_work_item_tracking_client()
+
+    watermark = store.get_watermark()
+    logger.info("Syncing revision store from watermark %s", watermark)
+
+    added = 0
+    while True:
+        batch = wit_client.read_reporting_revisions_get(project=context.project_name, fields=REVISION_STORE_FIELDS,
+                                                        continuation_token=watermark)
+
+        # The SDK model does not map the batch attributes, they end up in additional_properties
+        properties = getattr(batch, 'additional_properties', None) or {}
+        values = batch.values if batch.values is not None else properties.get('values', [])
+        continuation_token = batch.continuation_token or properties.get('continuationToken')
+        is_last_batch = batch.is_last_batch if batch.is_last_batch is not None else properties.get('isLastBatch', True)
+
+        revisions = []
+        for value in values:
+            fields = value.fields if hasattr(value, 'fields') else value.get('fields', {})
+            revisions.append((fields["System.Id"], fields["System.Rev"],
+                              parse_devops_date(fields["System.ChangedDate"]),
+                              get_actual_percent(fields)))
+
+        if continuation_token:
+            watermark = continuation_token
+        store.add_revisions(revisions, watermark)
+        added += len(revisions)
+
+        if is_last_batch or not continuation_token:
+            break
+
+    logger.info("Added %s revisions to the revision store", added)
+    return added
+
+
+def get_store_change_logs(context, ids):
+    """
+    :param context: Pass the current Context
+    :param ids: Work Item IDs
+    :return: Dict of Work Item ID to change log. The store is synced once per run and then read
+             without any per Work Item requests.
+    """
+    store_file = getattr(context, 'revision_store_file', None) or DEFAULT_REVISION_STORE_FILE
+
+    if not hasattr(context.runner_cache, 'store_change_logs'):
+        with RevisionStore(store_file) as store:
+            sync_revision_store(context, store)
+        context.runner_cache.store_change_logs = {}
+    change_logs = context.runner_cache.store_change_logs
+
+    missing_ids = [int(id_) for id_ in ids if int(id_) not in change_logs]
+    if missing_ids:
+        with RevisionStore(store_file) as store:
+            for id_, changes in store.get_changes(missing_ids).items():
+                change_logs[id_] = compact_change_log(changes)
+
+    return change_logs
+
+
+def get_actual_percents_as_of(context, ids, as_of_date):
+    """
+    :param context: Pass the current Context
+    :param ids: Work Item IDs
+    :param as_of_date: As of date
+    :return: Dict of Work Item ID to Actual (White) percentage
+    """
+    actuals_mode = getattr(context, 'actuals_mode', 'batch')
+    if actuals_mode not in ACTUALS_MODES:
+        raise ValueError("{0} is not a valid actuals mode, expected one of {1}".format(actuals_mode, ACTUALS_MODES))
+
+    if actuals_mode == 'batch':
+        work_items = get_work_items_as_of_batch(context, ids=ids, as_of_date=as_of_date, fields=ACTUALS_FIELDS)
+        return {id_: get_work_item_actual_percent(work_item) for id_, work_item in work_items.items()}
+
+    if actuals_mode in ('history', 'store'):
+        as_of_date = datetime.datetime.strptime(str(as_of_date), '%Y-%m-%d %H:%M:%S')
+        if actuals_mode == 'history':
+            change_logs = get_work_item_change_logs(context, ids)
+        else:
+            change_logs = get_store_change_logs(context, ids)
+        return {int(id_): get_actual_percent_from_change_log(change_logs[int(id_)], as_of_date) for id_ in ids}
+
+    ids = [int(id_) for id_ in ids]
+    percents = bounded_map(lambda id_: get_work_item_actual_percent_as_of(context, id_, as_of_date), ids,
+                           max_concurrency=get_max_concurrency(context))
+    return dict(zip(ids, percents))
+
+
+def get_work_item_percent_as_of(context, df_work_items, current_week, as_of_week, test_run, green_pcts=None,
+                                red_pcts=None):
     """
     :param context: Pass the current Context
     :param df_work_items: Work Item for which the red, white and actual completion percentage need to be calculated
     :param current_week: This Week starting (Monday)
     :param as_of_week: As of Week date to get Historic Completion Percentage
     :param test_run: Boolean
+    :param green_pcts: GREEN percentage of each Work Item for the week, from calc_forecast_matrices
+    :param red_pcts: RED percentage of each Work Item for the week, from calc_forecast_matrices
     :return: List of Red, Green and Actual (White) percentage of completion
     """
     df_intr = []
@@ -254,41 +579,31 @@ def get_work_item_percent_as_of(context, df_work_items, current_week, as_of_week
         as_of_week_starting = as_of_week
         future_week = False
 
-    # For each Work Item with Program Deliverable Tag
-    for wi_index, wi_row in df_work_items.iterrows():
-        # Set previous white_pct to 0.
+    # Fetch Actual (White) percentage for all Work Items of the week up front
+    actuals = None
+    if not (context.future_actuals_are_None and future_week):
+        actuals = get_actual_percents_as_of(context, ids=df_work_items['System.Id'], as_of_date=as_of_week_starting)
 
-        current_wi_id = wi_row['System.Id']
-        logger.debug("Processing Work Item %s", current_wi_id)
+    # Calculate GREEN and RED Progress % for all Work Items at once, unless already calculated for the week
+    if green_pcts is None or red_pcts is None:
+        green_pcts, red_pcts = calc_forecast_matrices(df_work_items, [as_of_week])
+        green_pcts, red_pcts = green_pcts[:, 0], red_pcts[:, 0]
 
-        # Calculate GREEN Progress %
-        green_pct = calc_pct_completion(wi_row['Custom.GreenStartDate'], wi_row['Custom.GreenEndDate'],
-                                        as_of_week)
+    report_date = datetime.datetime.strptime(str(as_of_week), '%Y-%m-%d %H:%M:%S').date()
 
-        # Calculate RED Progress %
-        red_pct = calc_pct_completion(wi_row['Custom.RedStartDate'], wi_row['Custom.RedEndDate'], as_of_week)
+    # For each Work Item with Program Deliverable Tag
+    for position, (wi_index, current_wi_id) in enumerate(df_work_items['System.Id'].items()):
+        logger.debug("Processing Work Item %s", current_wi_id)
 
-        id = current_wi_id
-        id = str(id) + ',' + str(id + 1)
+        green_pct = float(green_pcts[position])
+        red_pct = float(red_pcts[position])
 
         # if context.future_actuals_are_None and current_week
         if context.future_actuals_are_None and future_week:
             white_pct = float(numpy.nan)
 
         elif prev_white_pct < 100:
-            # Get White Progress % from the WorkItem as of given Week Starting Date
-            df_wi_tmp = get_work_items_as_of(context, as_of_date=as_of_week_starting, desired_id_range=id,
-                                             fields=context.fields_array)
-
-            # Parse and retrieve the ProgressPercentageComplete
-            for it in df_wi_tmp:
-                try:
-                    white_pct = int(it.fields["Custom.ProgressPercentageComplete"])
-
-                except KeyError as e:
-                    # Key Error occurs when the Key not found in the object
-                    # When the field was not updated as of the given date, the value should be set to 0
-                    white_pct = 0
+            white_pct = actuals.get(int(current_wi_id), 0)
 
         else:
             white_pct = 100
@@ -300,8 +615,7 @@ def get_work_item_percent_as_of(context, df_work_items, current_week, as_of_week
         prev_white_pct = white_pct
 
         # WARNING : Any alteration in the below statement would need further changes at the Dataframe column definition
-        df_intr.append([current_wi_id, datetime.datetime.strptime(str(as_of_week), '%Y-%m-%d %H:%M:%S').date(),
-                        round(green_pct), round(red_pct), white_pct])
+        df_intr.append([current_wi_id, report_date, round(green_pct), round(red_pct), white_pct])
 
         # If Text Exit in 5 iterations
         if test_run and wi_index > 5: